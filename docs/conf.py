@@ -18,13 +18,25 @@
 #
 # import sys
 # sys.path.insert(0, os.path.abspath('.'))
+from functools import lru_cache
+import glob
+import hashlib
+import mmap
 import os
 import pathlib
 import re
+import socket
 import subprocess
+import time
+from types import MappingProxyType
+import urllib.request
 
-import requests
+_PRODUCT_VERSION_RE = re.compile(
+    rb'PRODUCT_(MAJOR|MINOR|PATCH)_VERSION\s+(\d+)')
+_CMAKE_VARIABLE_RE = re.compile(r'@(\w+)@')
 
+
+@lru_cache(maxsize=None)
 def get_cmake_project_version(cmakelists):
     """
     Get the project version from a file
@@ -32,7 +44,7 @@ def get_cmake_project_version(cmakelists):
     The function looks for project(<name> VERSION major.minor.patch)
 
     :param cmakelists: The file to scan for the version
-    :return: A dict in the manner:
+    :return: A read-only mapping, as the result is cached, in the manner:
         {
             'major': int,
             'minor': int,
@@ -43,11 +55,12 @@ def get_cmake_project_version(cmakelists):
         r'project\(.*VERSION\s+(\d+)\.(\d+)\.(\d+)',
         "".join(open(cmakelists, 'r').readlines()),
         flags=re.MULTILINE)[0]
-    return {
+    return MappingProxyType({
         'major': matches[0],
         'minor': matches[1],
-        'patch': matches[2] }
+        'patch': matches[2] })
 
+@lru_cache(maxsize=None)
 def get_version(cmakelists):
     """
     Get the project version from a file
@@ -56,7 +69,7 @@ def get_version(cmakelists):
     PRODUCT_PATCH_VERSION in the given file
 
     :param cmakelists: The file to scan for the version
-    :return: A dict in the manner:
+    :return: A read-only mapping, as the result is cached, in the manner:
         {
             'major': int,
             'minor': int,
@@ -64,22 +77,124 @@ def get_version(cmakelists):
         }
     """
     version = {}
-    with open(cmakelists, 'r') as f:
-        for line in f:
-            if re.search('PRODUCT_MAJOR_VERSION', line):
-                version['major'] = line.split()[1][:-1]
-            if re.search('PRODUCT_MINOR_VERSION', line):
-                version['minor'] = line.split()[1][:-1]
-            if re.search('PRODUCT_PATCH_VERSION', line):
-                version['patch'] = line.split()[1][:-1]
-            if ('major' in version and
-                    'minor' in version and
-                    'patch' in version):
-                break
-    return version
-
-
-def download_css(html_css_dir):
+    with open(cmakelists, 'rb') as f:
+        # Empty files cannot be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return MappingProxyType(version)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for match in _PRODUCT_VERSION_RE.finditer(data):
+                version.setdefault(
+                    match.group(1).decode().lower(), match.group(2).decode())
+                if len(version) == 3:
+                    break
+    return MappingProxyType(version)
+
+
+def _write_if_changed(path, data):
+    """
+    Write data to a file only if its content differs from the existing one.
+
+    The file is written to a temporary file and atomically renamed, so its
+    modification time only changes when the content actually does.
+
+    :param path: Path to the file to write.
+    :param data: The bytes to write.
+    :return: True if the file was written. False if it was already up to date.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return True
+
+
+def _stream_to_tmp(response, path):
+    """
+    Stream the body of an HTTP response to a temporary file next to a path.
+
+    :param response: The streamed response to read the body from.
+    :param path: Path of the file the temporary one is intended to replace.
+    :return: A tuple with the path to the temporary file and the hexadecimal
+        BLAKE2b digest of its content.
+    """
+    tmp_path = '{}.tmp'.format(path)
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in response.iter_content(65536):
+                f.write(chunk)
+                digest.update(chunk)
+    except BaseException:
+        # Do not leave partial downloads behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest()
+
+
+def _file_digest(path):
+    """
+    Compute the digest of the content of a file.
+
+    :param path: Path to the file.
+    :return: The hexadecimal BLAKE2b digest of the file content,
+        or None if the file cannot be read.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def _css_cache_fresh(path, marker_path, max_age=86400):
+    """
+    Check whether a previously downloaded CSS file can be reused as is.
+
+    The freshness is taken from a marker file that is touched every time the
+    stylesheet is checked against the remote one, so the modification time of
+    the stylesheet itself only changes along with its content.
+
+    :param path: Path to the downloaded CSS stylesheet.
+    :param marker_path: Path to the marker of the last successful check.
+    :param max_age: Maximum age, in seconds, for the check to be fresh.
+    :return: True if the stylesheet exists and was checked less than max_age
+        seconds ago. False if not.
+    """
+    try:
+        return (os.path.isfile(path) and
+                time.time() - os.stat(marker_path).st_mtime < max_age)
+    except OSError:
+        return False
+
+
+def _css_download_failed(theme_path, reason):
+    """
+    Report a failed download of the eProsima rtd theme.
+
+    A previously downloaded stylesheet is still preferred to the local one.
+
+    :param theme_path: Path to the downloaded CSS stylesheet.
+    :param reason: Description of the failure.
+    :return: True if a previously downloaded stylesheet is available.
+        False if not.
+    """
+    print(
+        'Failed to download the CSS with the eProsima rtd theme. '
+        '{}'.format(reason))
+    return os.path.isfile(theme_path)
+
+
+def download_css(html_css_dir, cache_dir):
     """
     Download the common theme of eProsima readthedocs documentation.
 
@@ -87,49 +202,119 @@ def download_css(html_css_dir):
     repository with the index of all eProsima product documentation
     (https://github.com/eProsima/all-docs).
 
+    A previously downloaded stylesheet is reused without any request if it is
+    fresh. Otherwise, a conditional request is sent so that an unchanged
+    stylesheet is not downloaded again.
+
     :param html_css_dir: The directory to save the CSS stylesheet.
-    :return: True if the file was downloaded and generated successfully.
-        False if not.
+    :param cache_dir: The directory to save the download metadata, which
+        must not be published along with the stylesheet.
+    :return: True if the file was downloaded and generated successfully,
+        or if a previously downloaded one is available. False if not.
     """
     url = (
         'https://raw.githubusercontent.com/eProsima/all-docs/'
         'master/source/_static/css/fiware_readthedocs.css')
-    try:
-        req = requests.get(url, allow_redirects=True, timeout=10)
-    except requests.RequestException as e:
-        print(
-            'Failed to download the CSS with the eProsima rtd theme.'
-            'Request Error: {}'.format(e)
-        )
-        return False
-    if req.status_code != 200:
-        print(
-            'Failed to download the CSS with the eProsima rtd theme.'
-            'Return code: {}'.format(req.status_code))
-        return False
-    os.makedirs(
-        os.path.dirname('{}/_static/css/'.format(html_css_dir)),
-        exist_ok=True)
-    theme_path = '{}/_static/css/eprosima_rtd_theme.css'.format(html_css_dir)
-    with open(theme_path, 'wb') as f:
+    css_dir = pathlib.Path(html_css_dir, '_static', 'css')
+    theme_path = str(css_dir / 'eprosima_rtd_theme.css')
+    cache_path = pathlib.Path(cache_dir)
+    etag_path = str(cache_path / 'eprosima_rtd_theme.css.etag')
+    last_modified_path = str(
+        cache_path / 'eprosima_rtd_theme.css.last-modified')
+    if _css_cache_fresh(theme_path, etag_path):
+        return True
+
+    # Avoid waiting for the request timeouts when there is no network
+    if os.environ.get('SPHINX_NO_NETWORK') == '1':
+        return _css_download_failed(
+            theme_path, 'Network disabled by SPHINX_NO_NETWORK')
+    # The probe connects directly, so it is skipped when the request is going
+    # to be sent through a proxy
+    proxies = urllib.request.getproxies()
+    if 'https' not in proxies and 'all' not in proxies:
         try:
-            f.write(req.content)
+            socket.create_connection(
+                ('raw.githubusercontent.com', 443), timeout=1).close()
+        except OSError as e:
+            return _css_download_failed(
+                theme_path, 'Network Error: {}'.format(e))
+
+    # Only imported when a request is actually sent, so cached, offline and
+    # non-HTML builds avoid the import cost
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # The validators are the ones sent by the server, as the modification
+    # time of the stylesheet is the one of the checkout
+    headers = {}
+    if os.path.isfile(theme_path):
+        for header, path in (
+                ('If-None-Match', etag_path),
+                ('If-Modified-Since', last_modified_path)):
+            try:
+                with open(path, 'r') as f:
+                    value = f.read().strip()
+            except OSError:
+                continue
+            if value:
+                headers[header] = value
+    cache_path.mkdir(parents=True, exist_ok=True)
+    # Retry only on transient errors, never on permanent ones such as 404
+    with requests.Session() as session:
+        session.mount('https://', HTTPAdapter(max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']))))
+        try:
+            with session.get(
+                url, headers=headers, allow_redirects=True, stream=True,
+                timeout=(3.05, 10)
+            ) as req:
+                if req.status_code == 304:
+                    pathlib.Path(etag_path).touch()
+                    return True
+                if req.status_code != 200:
+                    return _css_download_failed(
+                        theme_path,
+                        'Return code: {}'.format(req.status_code))
+                css_dir.mkdir(parents=True, exist_ok=True)
+                tmp_path, digest = _stream_to_tmp(req, theme_path)
+                etag = req.headers.get('ETag')
+                last_modified = req.headers.get('Last-Modified')
+        except requests.RequestException as e:
+            return _css_download_failed(
+                theme_path, 'Request Error: {}'.format(e))
         except OSError:
-            print('Failed to create the file: {}'.format(theme_path))
-            return False
+            return _css_download_failed(
+                theme_path, 'Failed to create the file: {}'.format(theme_path))
+
+    # Only replace the stylesheet if its content has changed, so its
+    # modification time does not invalidate the incremental builds
+    if digest == _file_digest(theme_path):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, theme_path)
+    # The ETag sidecar also marks the time of the last successful check
+    with open(last_modified_path, 'w') as f:
+        f.write(last_modified or '')
+    with open(etag_path, 'w') as f:
+        f.write(etag or '')
     return True
 
 
-def select_css(html_css_dir):
+def select_css(html_css_dir, cache_dir):
     """
     Select CSS file with the website's template.
 
     :param html_css_dir: The directory to save the CSS stylesheet.
+    :param cache_dir: The directory to save the download metadata.
     :return: Returns a list of CSS files to be imported.
     """
     common_css = '_static/css/eprosima_rtd_theme.css'
     local_css = '_static/css/fiware_readthedocs.css'
-    if download_css(html_css_dir):
+    if download_css(html_css_dir, cache_dir):
         print('Applying common CSS style file: {}'.format(common_css))
         return [common_css]
     else:
@@ -159,76 +344,121 @@ def configure_doxyfile(
     with open(doxyfile_in, 'r') as file:
         filedata = file.read()
 
-    filedata = filedata.replace('@DOXYGEN_INPUT_DIR@', input_dir)
-    filedata = filedata.replace('@DOXYGEN_OUTPUT_DIR@', output_dir)
-    filedata = filedata.replace(
-        '@PROJECT_BINARY_DIR@', project_binary_docs_dir
-    )
-    filedata = filedata.replace(
-        '@PROJECT_SOURCE_DIR@', project_source_docs_dir
-    )
+    # Unknown @VAR@ tokens are kept as they are
+    variables = {
+        'DOXYGEN_INPUT_DIR': input_dir,
+        'DOXYGEN_OUTPUT_DIR': output_dir,
+        'PROJECT_BINARY_DIR': project_binary_docs_dir,
+        'PROJECT_SOURCE_DIR': project_source_docs_dir,
+    }
+    filedata = _CMAKE_VARIABLE_RE.sub(
+        lambda m: variables.get(m.group(1), m.group(0)), filedata)
+
+    pathlib.Path(doxyfile_out).parent.mkdir(parents=True, exist_ok=True)
+    _write_if_changed(doxyfile_out, filedata.encode())
+
+
+def doxygen_inputs_digest(input_dir, doxyfile_out):
+    """
+    Compute a digest of the content of every Doxygen input.
 
-    os.makedirs(os.path.dirname(doxyfile_out), exist_ok=True)
-    with open(doxyfile_out, 'w') as file:
-        file.write(filedata)
+    :param input_dir: Directory with the header files parsed by Doxygen
+    :param doxyfile_out: Path to the configured Doxygen configuration file
+    :return: The hexadecimal BLAKE2b digest of the inputs.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for path in sorted(
+            glob.glob('{}/**/*'.format(input_dir), recursive=True)):
+        if not os.path.isfile(path):
+            continue
+        digest.update(os.path.relpath(path, input_dir).encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    with open(doxyfile_out, 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def doxygen_outdated(input_dir, doxyfile_out, output_dir):
+    """
+    Check whether the Doxygen XML output is older than its inputs.
+
+    Inputs with a newer modification time but the same content as in the
+    last generation, as stored in output_dir/.inputs.hash, are not
+    considered outdated. The generation can be forced by setting the
+    FORCE_DOXYGEN environment variable to 1.
+
+    :param input_dir: Directory with the header files parsed by Doxygen
+    :param doxyfile_out: Path to the configured Doxygen configuration file
+    :param output_dir: Directory where Doxygen generates its output
+    :return: True if Doxygen needs to be run. False if not.
+    """
+    if os.environ.get('FORCE_DOXYGEN') == '1':
+        return True
+    # The stamp is only written after a successful generation, so an output
+    # without it may be partial
+    try:
+        with open(pathlib.Path(output_dir) / '.inputs.hash', 'r') as f:
+            stamp = f.read()
+    except OSError:
+        return True
+    dst_mtime = max(
+        (os.path.getmtime(p)
+         for p in glob.glob('{}/xml/*.xml'.format(output_dir))),
+        default=0)
+    if dst_mtime == 0:
+        return True
+    # The modification times only decide whether the digest of the inputs
+    # needs to be computed. The input directory itself is included so that
+    # removing a header right under it is also detected
+    src_mtime = max(
+        os.path.getmtime(p)
+        for p in [input_dir] + glob.glob(
+            '{}/**/*'.format(input_dir), recursive=True))
+    if (src_mtime <= dst_mtime and
+            os.path.getmtime(doxyfile_out) <= dst_mtime):
+        return False
+    return stamp != doxygen_inputs_digest(input_dir, doxyfile_out)
 
 
-script_path = os.path.abspath(pathlib.Path(__file__).parent.absolute())
+script_path = pathlib.Path(__file__).resolve().parent
+root_path = script_path.parent
+binary_path = root_path / 'build'
+binary_docs_path = binary_path / 'docs'
+doxygen_path = binary_docs_path / 'doxygen'
 # Project directories
-project_source_docs_dir = os.path.abspath('{}/rst'.format(script_path))
-project_binary_dir = os.path.abspath('{}/../build'.format(script_path))
-project_binary_docs_dir = os.path.abspath(
-    '{}/docs'.format(project_binary_dir)
-)
-output_dir = os.path.abspath('{}/doxygen'.format(project_binary_docs_dir))
-doxygen_html = os.path.abspath(
-    '{}/doxygen/html'.format(project_binary_docs_dir)
-)
+project_source_docs_dir = str(script_path / 'rst')
+project_binary_dir = str(binary_path)
+project_binary_docs_dir = str(binary_docs_path)
+output_dir = str(doxygen_path)
+doxygen_html = str(doxygen_path / 'html')
 
 # Doxyfile
-doxyfile_in = os.path.abspath(
-    '{}/doxygen-config.in'.format(script_path)
-)
-doxyfile_out = os.path.abspath(
-    '{}/doxygen-config'.format(project_binary_docs_dir)
-)
+doxyfile_in = str(script_path / 'doxygen-config.in')
+doxyfile_out = str(binary_docs_path / 'doxygen-config')
 
 # Header files
-input_dir = os.path.abspath(
-    '{}/../include/fastdds_statistics_backend'.format(
-        script_path
-    )
-)
+input_dir = str(root_path / 'include' / 'fastdds_statistics_backend')
 
 # Check if we're running on Read the Docs' servers
 read_the_docs_build = os.environ.get('READTHEDOCS', None) == 'True'
 if read_the_docs_build:
     print('Read the Docs environment detected!')
 
-    os.makedirs(os.path.dirname(output_dir), exist_ok=True)
-    os.makedirs(os.path.dirname(doxygen_html), exist_ok=True)
+    (doxygen_path / 'html').mkdir(parents=True, exist_ok=True)
 
     # Create a COLCON_IGNORE file just in case
-    open(
-        os.path.abspath('{}/COLCON_IGNORE'.format(project_binary_dir)), 'w'
-    ).close()
-
-    # Configure Doxyfile
-    configure_doxyfile(
-        doxyfile_in,
-        doxyfile_out,
-        input_dir,
-        output_dir,
-        project_binary_docs_dir,
-        project_source_docs_dir
-    )
-    # Generate doxygen documentation
-    subprocess.call('doxygen {}'.format(doxyfile_out), shell=True)
+    colcon_ignore = binary_path / 'COLCON_IGNORE'
+    if not colcon_ignore.exists():
+        colcon_ignore.touch()
 
 breathe_projects = {
-    'fastdds_statistics_backend': os.path.abspath('{}/xml'.format(output_dir))
+    'fastdds_statistics_backend': str(doxygen_path / 'xml')
 }
 breathe_default_project = 'fastdds_statistics_backend'
+# Builders for which the Doxygen XML is generated on Read the Docs
+doxygen_builders = {'html', 'dirhtml', 'singlehtml', 'latex', 'epub'}
 
 # -- General configuration ------------------------------------------------
 
@@ -243,20 +473,22 @@ extensions = [
     'breathe',
     'sphinx.ext.todo',
 ]
-try:
-    import sphinxcontrib.spelling  # noqa: F401
-    extensions.append('sphinxcontrib.spelling')
+# The spelling extension is only loaded when SPELLING_ENABLED is set
+if os.environ.get('SPELLING_ENABLED'):
+    try:
+        import sphinxcontrib.spelling  # noqa: F401
+        extensions.append('sphinxcontrib.spelling')
 
-    # spelling_word_list_filename = 'spelling_wordlist.txt'
-    spelling_word_list_filename = [
-        'rst/spelling_wordlist.txt',
-    ]
+        # spelling_word_list_filename = 'spelling_wordlist.txt'
+        spelling_word_list_filename = [
+            'rst/spelling_wordlist.txt',
+        ]
 
-    from sphinxcontrib.spelling.filters import ContractionFilter
-    spelling_filters = [ContractionFilter]
-    spelling_ignore_contributor_names = False
-except ImportError:
-    pass
+        from sphinxcontrib.spelling.filters import ContractionFilter
+        spelling_filters = [ContractionFilter]
+        spelling_ignore_contributor_names = False
+    except ImportError:
+        pass
 
 
 # Add any paths that contain templates here, relative to this directory.
@@ -286,7 +518,7 @@ author = u'eProsima'
 #
 # The short X.Y version.
 versions = get_cmake_project_version(
-    os.path.abspath('{}/../CMakeLists.txt'.format(script_path)))
+    str(root_path / 'CMakeLists.txt'))
 version = u'{}.{}'.format(versions['major'], versions['minor'])
 # The full version, including alpha/beta/rc tags.
 release = u'{}.{}.{}'.format(
@@ -312,10 +544,7 @@ language = 'en'
 # directories to ignore when looking for source files.
 # This patterns also effect to html_static_path and html_extra_path
 exclude_patterns = [
-    '*/includes/*.rst',
-    '*/*/includes/*.rst',
-    '*/*/*/includes/*.rst',
-    '*/*/*/*/includes/*.rst'
+    '**/includes/*.rst'
 ]
 
 # The reST default role (used for this markup: `text`) to use for all
@@ -350,7 +579,6 @@ suppress_warnings = [
     'cpp.duplicate_declaration',
     'cpp.parse_function_declaration',
     'config.cache'
-
 ]
 
 # If true, `todo` and `todoList` produce output, else they produce nothing.
@@ -398,9 +626,8 @@ html_theme = 'sphinx_rtd_theme'
 # so a file named "default.css" will overwrite the builtin "default.css".
 html_static_path = ['rst/_static']
 
-html_context = {
-        'css_files': select_css(project_source_docs_dir),
-        }
+# The CSS files are selected once the builder is known, see setup()
+html_context = {}
 
 
 # Add any extra paths that contain custom files (such as robots.txt or
@@ -594,3 +821,66 @@ texinfo_documents = [
 # If true, do not generate a @detailmenu in the "Top" node's menu.
 #
 # texinfo_no_detailmenu = False
+
+
+# -- Sphinx application setup ---------------------------------------------
+
+def _select_html_css(app):
+    """
+    Select the CSS files only for builders producing HTML output.
+
+    :param app: The Sphinx application.
+    """
+    # The download metadata is kept along with the doctrees of the build,
+    # outside of the source tree
+    if app.builder.format == 'html':
+        app.config.html_context['css_files'] = select_css(
+            project_source_docs_dir, app.doctreedir)
+
+
+def _generate_doxygen(app):
+    """
+    Generate the Doxygen XML on Read the Docs for builders consuming it.
+
+    :param app: The Sphinx application.
+    """
+    if (not read_the_docs_build or
+            app.builder.name not in doxygen_builders):
+        return
+
+    # Configure Doxyfile
+    configure_doxyfile(
+        doxyfile_in,
+        doxyfile_out,
+        input_dir,
+        output_dir,
+        project_binary_docs_dir,
+        project_source_docs_dir
+    )
+    # Generate doxygen documentation only if the headers have changed
+    if doxygen_outdated(input_dir, doxyfile_out, output_dir):
+        # Remove the stamp first, so a failed generation is retried
+        stamp_path = pathlib.Path(output_dir) / '.inputs.hash'
+        if stamp_path.exists():
+            stamp_path.unlink()
+        subprocess.run(['doxygen', doxyfile_out], check=True)
+        _write_if_changed(
+            stamp_path,
+            doxygen_inputs_digest(input_dir, doxyfile_out).encode())
+    else:
+        print('Doxygen documentation is up to date')
+
+
+def setup(app):
+    """
+    Connect the documentation specific handlers to the Sphinx events.
+
+    :param app: The Sphinx application.
+    :return: The extension metadata.
+    """
+    app.connect('builder-inited', _generate_doxygen)
+    app.connect('builder-inited', _select_html_css)
+    return {
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }